@@ -1,15 +1,31 @@
 import asyncio
-import json
-import uuid
-import threading
+import re
 import os
-from typing import List, Dict, Any
+import socket
+import time
+from collections import OrderedDict
+from typing import Annotated, List, Dict, Any
 
+import aioconsole
+import orjson
 import paho.mqtt.client as mqtt
-from llama_index.core.agent.workflow import FunctionAgent
+from llama_index.core.agent.workflow import AgentStream, FunctionAgent
 from llama_index.llms.openai import OpenAI
 from llama_index.core.tools import FunctionTool, ToolMetadata
-from pydantic import BaseModel, Field
+from llama_index.core.workflow import Context
+from pydantic import BaseModel, Field, ValidationError
+
+
+# Pulls the request_id out of a raw feedback payload without a full JSON parse.
+_RID_RE = re.compile(rb'"request_id"\s*:\s*"([^"]+)"')
+
+# Feedback and waiters nobody consumes are dropped once either limit is exceeded.
+MAX_COMPLETED_MOVES = 1024
+COMPLETED_MOVE_TTL = 60.0 # seconds
+
+# Backoff between reconnect attempts while the broker is unreachable (paho's defaults).
+RECONNECT_MIN_DELAY = 1 # seconds
+RECONNECT_MAX_DELAY = 120 # seconds
 
 
 # --- 1. UnityMoverTool Class (Adapted for LlamaIndex) ---
@@ -18,59 +34,175 @@ class UnityMoverTool:
     def __init__(self, broker_address: str, port: int = 1883,
                  command_topic: str ="unity/commands/move",
                  feedback_topic: str = "unity/feedback/move_complete"):
-        self.client = mqtt.Client()
+        # A single connection keeps move commands in order: Unity abandons the
+        # running move whenever a new command arrives, so the last one must win.
+        self.client = mqtt.Client(
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+            client_id=f"unity-agent-{os.getpid()}",
+            clean_session=True,
+        )
         self.client.on_connect = self._on_connect
         self.client.on_message = self._on_message
+        # Drive the client from the asyncio event loop instead of a paho thread
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
         self.broker_address = broker_address
         self.port = port
         self.command_topic = command_topic
         self.feedback_topic = feedback_topic
 
-        # Store completed moves feedback
+        # Store completed moves feedback, oldest first
+        # Key: request_id
+        # Value: (time.monotonic() when received, feedback) where feedback is the raw
+        #        payload (parsed when it is consumed), or the already-parsed dict if
+        #        _on_message had to parse it
+        # Only touched from the event loop thread (_on_message and the async tools),
+        # so the multi-step eviction in _store_feedback needs no lock.
+        self.completed_moves = OrderedDict()
+
+        # Futures for moves someone may await via `await_move_completion`, oldest first.
+        # _on_message runs on the event loop and resolves them as soon as feedback arrives;
+        # moves that never report back are evicted with the same limits as completed_moves.
         # Key: request_id
-        # Value: The feedback payload
-        self.completed_moves = {}
-        self.completed_moves_lock = threading.Lock()
+        # Value: (time.monotonic() when created, asyncio.Future resolved with the feedback payload)
+        self._loop = asyncio.get_running_loop()
+        self._pending = OrderedDict()
 
         self._connect_mqtt()
 
     def _connect_mqtt(self):
-        """Connects to the MQTT broker and starts the loop."""
+        """Connects to the MQTT broker and hooks the client into the asyncio event loop."""
         try:
             self.client.connect(self.broker_address, self.port, 60)
-            self.client.loop_start() # Start MQTT client loop in background
             print(f"Attempting to connect to MQTT broker at {self.broker_address}:{self.port}")
         except Exception as e:
             print(f"Failed to connect to MQTT broker: {e}")
+        self._misc_task = self._loop.create_task(self._misc_loop())
 
-    def _on_connect(self, client, userdata, flags, rc):
+    async def _misc_loop(self):
+        """Runs paho's periodic housekeeping (keepalive pings, reconnects) on the event loop."""
+        reconnect_delay = RECONNECT_MIN_DELAY
+        while True:
+            await asyncio.sleep(1)
+            if self.client.loop_misc() != mqtt.MQTT_ERR_NO_CONN:
+                reconnect_delay = RECONNECT_MIN_DELAY
+                continue
+            # reconnect() blocks on the TCP connect, so keep it off the event loop
+            try:
+                await self._loop.run_in_executor(None, self.client.reconnect)
+            except Exception as e:
+                print(f"Failed to reconnect to MQTT broker: {e}. Retrying in {reconnect_delay}s.")
+                await asyncio.sleep(reconnect_delay)
+                reconnect_delay = min(reconnect_delay * 2, RECONNECT_MAX_DELAY)
+
+    def _call_in_loop(self, callback, *args):
+        """Runs callback on the event loop thread, where the loop's reader/writer registry lives."""
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError: # Socket callbacks fired by reconnect() on an executor thread
+            running_loop = None
+        if running_loop is self._loop:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        """Callback for when the client opens its socket; incoming data is read on the event loop."""
+        self._call_in_loop(self._loop.add_reader, sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        """Callback for when the client closes its socket."""
+        self._loop.remove_reader(sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        """Callback for when the client has outgoing data queued; it is written once the socket is writable."""
+        self._call_in_loop(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        """Callback for when the client has flushed its outgoing data."""
+        self._loop.remove_writer(sock)
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
         """Callback for when the client connects to the MQTT broker."""
-        if rc == 0:
+        if not reason_code.is_failure:
             print("Connected to MQTT Broker!")
+            # Commands are tiny packets; don't let Nagle hold them back waiting for an ACK
+            client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             client.subscribe(self.feedback_topic)
             print(f"Subscribed to feedback topic: {self.feedback_topic}")
         else:
-            print(f"Failed to connect, return code {rc}\n")
+            print(f"Failed to connect, reason code {reason_code}\n")
 
     def _on_message(self, client, userdata, msg):
         """Callback for when a PUBLISH message is received from the server."""
         if msg.topic == self.feedback_topic:
+            # Fast path: index the raw bytes by request_id and defer the full parse
+            # to check_move_status, which consumes each feedback at most once.
+            m = _RID_RE.search(msg.payload)
+            if m:
+                request_id = m.group(1).decode('utf-8')
+                self._store_feedback(request_id, msg.payload)
+                self._notify_waiter(request_id, msg.payload)
+                print(f"Received move completion feedback for ID '{request_id}': {msg.payload.decode('utf-8', 'replace')}")
+                return
+
             try:
-                payload = json.loads(msg.payload.decode('utf-8'))
+                payload = orjson.loads(msg.payload)
                 request_id = payload.get("request_id")
 
                 if request_id:
-                    with self.completed_moves_lock:
-                        self.completed_moves[request_id] = payload
+                    self._store_feedback(request_id, payload)
+                    self._notify_waiter(request_id, payload)
                     print(f"Received move completion feedback for ID '{request_id}': {payload}")
                 else:
                     print(f"Received move completion feedback without request_id: {payload}")
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 print(f"Failed to decode JSON from feedback message: {msg.payload}")
         else:
             print(f"Received message on unhandled topic: {msg.topic}")
 
-    def initiate_object_move_3d(self, object_name: str, target_position: List[float], duration: float = 2.0) -> Dict[str, Any]:
+    def _store_feedback(self, request_id, feedback):
+        """Records feedback for `check_move_status`, evicting old entries nobody consumed."""
+        now = time.monotonic()
+        self.completed_moves[request_id] = (now, feedback)
+        self.completed_moves.move_to_end(request_id)
+        self._evict_stale(self.completed_moves, now)
+
+    @staticmethod
+    def _evict_stale(entries, now):
+        """Drops the oldest (timestamp, value) entries beyond MAX_COMPLETED_MOVES or older than COMPLETED_MOVE_TTL."""
+        while entries:
+            stamped_at, _ = next(iter(entries.values()))
+            if len(entries) <= MAX_COMPLETED_MOVES and now - stamped_at <= COMPLETED_MOVE_TTL:
+                break
+            entries.popitem(last=False)
+
+    def _notify_waiter(self, request_id, feedback):
+        """Wakes up the `await_move_completion` call waiting on request_id, if any."""
+        entry = self._pending.pop(request_id, None)
+        if entry is not None and not entry[1].done(): # The waiter may already have timed out
+            entry[1].set_result(feedback)
+
+    @staticmethod
+    def _completed(feedback) -> Dict[str, Any]:
+        """Builds the "completed" status response from a stored feedback payload."""
+        if isinstance(feedback, bytes):
+            # The request_id regex matched, but the rest of the payload is only checked here
+            try:
+                parsed = orjson.loads(feedback)
+            except orjson.JSONDecodeError:
+                parsed = None
+            if not isinstance(parsed, dict):
+                return {"status": "error", "message": f"Failed to decode JSON from feedback message: {feedback.decode('utf-8', 'replace')}"}
+            feedback = parsed
+        # Consumed feedback is ours to mutate; like the old {"status": "completed", **feedback},
+        # a status reported by Unity ("success"/"failure") takes precedence.
+        feedback.setdefault("status", "completed")
+        return feedback
+
+    async def initiate_object_move_3d(self, object_name: str, target_position: List[float], duration: float = 2.0) -> Dict[str, Any]:
         """
         Sends a command to move a specified object in the 3D environment to a target coordinate,
         interpolating smoothly. This tool initiates the movement but does not wait for its completion.
@@ -84,34 +216,50 @@ class UnityMoverTool:
         Returns:
             Dict[str, Any]: A dictionary indicating the status of the command and the request ID.
         """
-        if not (isinstance(target_position, list) and len(target_position) == 3 and
-                all(isinstance(coord, (int, float)) for coord in target_position)):
-            return {"status": "error", "message": "Invalid target_position. Must be a list of 3 numbers."}
-        if not (isinstance(duration, (int, float)) and duration > 0):
-            return {"status": "error", "message": "Invalid duration. Must be a positive number."}
-
-        request_id = str(uuid.uuid4()) # Generate a unique ID for this request
+        # The tool schema carries the constraints; pydantic's compiled validator enforces them
+        try:
+            move = InitiateMoveSchema.model_validate(
+                {"object_name": object_name, "target_position": target_position, "duration": duration})
+        except ValidationError as e:
+            error = e.errors()[0]
+            return {"status": "error", "message": f"Invalid {error['loc'][0]}. {error['msg']}."}
+        x, y, z = move.target_position
+        duration = move.duration
+
+        request_id = os.urandom(16).hex() # Generate a unique 128-bit ID for this request
+
+        # The command schema is fixed, so splice the JSON together from pre-encoded
+        # keys instead of running the encoder over a dict. Only object_name needs
+        # escaping; floats use repr(), the shortest form that round-trips.
+        payload = (
+            b'{"object_name":' + orjson.dumps(object_name) +
+            f',"target_position":[{x!r},{y!r},{z!r}]'
+            f',"duration":{float(duration)!r}'
+            f',"request_id":"{request_id}"}}'.encode() # Include the request ID in the command
+        )
 
-        payload = {
+        # Register the waiter before publishing so fast feedback cannot be missed
+        now = time.monotonic()
+        self._pending[request_id] = (now, self._loop.create_future())
+        self._evict_stale(self._pending, now)
+
+        # Fire-and-forget: QoS 0 needs no PUBACK, completion comes back as feedback.
+        # publish() only queues the packet; the event loop writes it when the socket
+        # is writable, so this never blocks. Failures are reported through rc.
+        info = self.client.publish(self.command_topic, payload, qos=0, retain=False)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self._pending.pop(request_id, None)
+            return {"status": "error", "message": f"Failed to send MQTT message: {mqtt.error_string(info.rc)}"}
+
+        return {
+            "status": "success",
+            "message": f"Move command initiated for {object_name} to {target_position} over {duration} seconds.",
             "object_name": object_name,
-            "target_position": target_position,
-            "duration": duration,
-            "request_id": request_id # Include the request ID in the command
+            "requested_target_position": target_position,
+            "request_id": request_id
         }
 
-        try:
-            self.client.publish(self.command_topic, json.dumps(payload))
-            return {
-                "status": "success",
-                "message": f"Move command initiated for {object_name} to {target_position} over {duration} seconds.",
-                "object_name": object_name,
-                "requested_target_position": target_position,
-                "request_id": request_id
-            }
-        except Exception as e:
-            return {"status": "error", "message": f"Failed to send MQTT message: {e}"}
-
-    def check_move_status(self, request_id: str) -> Dict[str, Any]:
+    async def check_move_status(self, request_id: str) -> Dict[str, Any]:
         """
         Checks the completion status of a previously initiated object movement using its request ID.
         This tool will return the completion feedback if the movement has completed for the given request ID.
@@ -124,18 +272,47 @@ class UnityMoverTool:
             Dict[str, Any]: A dictionary containing the status ("completed", "in_progress", "not_found")
                             and the feedback data if completed.
         """
-        with self.completed_moves_lock:
-            feedback = self.completed_moves.get(request_id)
-            if feedback:
-                del self.completed_moves[request_id] # Consume the feedback once retrieved
-                return {"status": "completed", **feedback}
-            else:
-                return {"status": "in_progress", "message": f"Move for request_id {request_id} not yet completed or found."}
+        entry = self.completed_moves.pop(request_id, None) # Consume the feedback once retrieved
+        if entry:
+            return self._completed(entry[1])
+        else:
+            return {"status": "in_progress", "message": f"Move for request_id {request_id} not yet completed or found."}
+
+    async def await_move_completion(self, request_id: str, timeout: float = 15.0) -> Dict[str, Any]:
+        """
+        Waits for the completion feedback of a previously initiated object movement.
+        Returns as soon as the feedback arrives instead of polling `check_move_status`.
+
+        Args:
+            request_id (str): The unique ID of the specific move request to wait for.
+            timeout (float, optional): The maximum time in seconds to wait. Defaults to 15.0 seconds.
+
+        Returns:
+            Dict[str, Any]: The same dictionary `check_move_status` returns; "in_progress" if
+                            the move did not complete within the timeout.
+        """
+        # Feedback stays in completed_moves so the agent can still check on this move
+        entry = self._pending.get(request_id)
+        if entry is None:
+            # Feedback already arrived (or the ID is unknown)
+            stored = self.completed_moves.get(request_id)
+            if stored:
+                return self._completed(stored[1])
+            return {"status": "in_progress", "message": f"Move for request_id {request_id} not yet completed or found."}
+
+        try:
+            feedback = await asyncio.wait_for(entry[1], timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(request_id, None)
+            return {"status": "in_progress", "message": f"Move for request_id {request_id} not completed within {timeout} seconds."}
+
+        return self._completed(feedback)
 
     def disconnect(self):
         """Disconnects the MQTT client."""
-        self.client.loop_stop()
+        self._misc_task.cancel()
         self.client.disconnect()
+        self.client.loop_write() # Flush the DISCONNECT packet; nothing drives the socket after this
         print("Disconnected from MQTT broker.")
 
 
@@ -143,14 +320,29 @@ class UnityMoverTool:
 class InitiateMoveSchema(BaseModel):
     """Initiates a smooth movement for a 3D object to a target position."""
     object_name: str = Field(..., description="The name or ID of the 3D object to be moved (e.g., 'MyCube').")
-    target_position: List[float] = Field(..., description="A list of three floating-point numbers [x, y, z] for the destination.")
-    duration: float = Field(default=2.0, description="The time in seconds for the movement. Defaults to 2.0 seconds.")
+    # nan/inf are rejected: they have no JSON representation and Unity would drop the command
+    target_position: List[Annotated[float, Field(allow_inf_nan=False)]] = Field(..., min_length=3, max_length=3, description="A list of three floating-point numbers [x, y, z] for the destination.")
+    duration: float = Field(default=2.0, gt=0, allow_inf_nan=False, description="The time in seconds for the movement. Defaults to 2.0 seconds.")
 
 class CheckStatusSchema(BaseModel):
     """Checks if a previously initiated 3D object movement has completed."""
     request_id: str = Field(..., description="The unique ID of the specific move request to check, obtained from `initiate_object_move_3d`.")
 
 
+# Keep this byte-identical across runs (no timestamps, request IDs, etc.) so the
+# LLM server can reuse its cached KV state for the prompt prefix.
+SYSTEM_PROMPT = (
+    "You are an AI assistant capable of controlling a 3D object named 'Cube' in a Unity environment. "
+    "You can initiate movements and check their completion status. "
+    "When asked to move an object, use `initiate_object_move_3d` and then reply; "
+    "do not call `check_move_status` right after it, as completion is reported to the user automatically. "
+    "Only if the user asks for completion or if you need to perform a subsequent action, "
+    "use `check_move_status` once with the `request_id` you received from the `initiate_object_move_3d` call. "
+    "If a move is still in progress, inform the user and suggest checking again later. "
+    "Always refer to the object as 'Cube' unless specified otherwise."
+)
+
+
 # --- 2. LlamaIndex Agent Setup ---
 async def main():
     # Initialize your UnityMoverTool instance
@@ -159,7 +351,7 @@ async def main():
 
     # Create LlamaIndex FunctionTool objects from the UnityMoverTool methods
     initiate_move_tool = FunctionTool.from_defaults(
-        fn=unity_mover.initiate_object_move_3d,
+        async_fn=unity_mover.initiate_object_move_3d,
         name="initiate_object_move_3d",
         description=(
             "Sends a command to move a specified object in the 3D environment to a target coordinate, "
@@ -175,7 +367,7 @@ async def main():
     )
 
     check_status_tool = FunctionTool.from_defaults(
-        fn=unity_mover.check_move_status,
+        async_fn=unity_mover.check_move_status, # Runs on the loop thread, like _on_message
         name="check_move_status",
         description=(
             "Checks the completion status of a previously initiated object movement using its request ID. "
@@ -196,19 +388,13 @@ async def main():
         api_base="http://127.0.0.1:8080/v1",
         api_key="sk-no-key-required", # Can be any string
         temperature=0.0,
+        # llama.cpp extension: reuse the KV cache for the unchanged prompt prefix
+        additional_kwargs={"extra_body": {"cache_prompt": True}},
     )
     agent = FunctionAgent(
         tools=[initiate_move_tool, check_status_tool],
         llm=llm,
-        system_prompt=(
-            "You are an AI assistant capable of controlling a 3D object named 'Cube' in a Unity environment. "
-            "You can initiate movements and check their completion status. "
-            "When asked to move an object, first use `initiate_object_move_3d`. "
-            "Then, if the user asks for completion or if you need to perform a subsequent action, "
-            "periodically use `check_move_status` with the `request_id` you received from the `initiate_object_move_3d` call. "
-            "If a move is still in progress, inform the user and suggest checking again later. "
-            "Always refer to the object as 'Cube' unless specified otherwise."
-        ),
+        system_prompt=SYSTEM_PROMPT,
     )
 
     # --- 3. Interactive Agent Loop ---
@@ -216,9 +402,13 @@ async def main():
     print("Enter a command to the agent. For example: 'Move Cube to [0.0, 5.0, 0.0] over 3 seconds.'")
     print("Type 'quit' or 'exit' to end the session.")
 
+    # Share one context across turns so the chat history (and the LLM server's
+    # cached prefix for it) carries over instead of starting fresh each run
+    ctx = Context(agent)
+
     try:
         while True:
-            user_input = input("User > ")
+            user_input = await aioconsole.ainput("User > ") # Keeps the event loop (and MQTT) running
             if user_input.lower() in ["quit", "exit"]:
                 print("Exiting...")
                 break
@@ -226,8 +416,14 @@ async def main():
             if not user_input.strip():
                 continue
 
-            response_initiate = await agent.run(user_input)
-            print(f"Agent: {response_initiate}")
+            # Stream tokens as they are generated instead of waiting for the full reply
+            handler = agent.run(user_input, ctx=ctx)
+            print("Agent: ", end="", flush=True)
+            async for event in handler.stream_events():
+                if isinstance(event, AgentStream):
+                    print(event.delta, end="", flush=True)
+            print()
+            response_initiate = await handler
 
             # --- Handle Move Completion ---
             # Extract request_id if a move was initiated
@@ -242,21 +438,18 @@ async def main():
                             print(f"Could not extract request_id from tool output: {tool_output}")
                         break
 
-            # If a move was initiated, periodically check for its completion
+            # If a move was initiated, wait for its completion feedback
             if request_id_from_agent:
-                print(f"Move initiated with request_id: {request_id_from_agent}. Periodically checking status...")
-                for i in range(10):  # Check up to 10 times
-                    await asyncio.sleep(1.5)
-                    check_prompt = f"Is the move with request ID {request_id_from_agent} complete?"
-                    response_check = await agent.run(check_prompt)
-                    print(f"Agent (status check): {response_check}")
-
-                    if "completed" in str(response_check).lower():
-                        print("Agent confirmed move completed!")
-                        break
+                print(f"Move initiated with request_id: {request_id_from_agent}. Waiting for completion...")
+                result = await unity_mover.await_move_completion(request_id_from_agent, timeout=15)
+                if result["status"] == "in_progress":
+                    print("No completion feedback received. Move may not have completed.")
+                elif result["status"] == "error":
+                    print(f"Could not read completion feedback: {result['message']}")
                 else:
-                    print("Agent stopped checking. Move may not have completed.")
-    except (KeyboardInterrupt, EOFError):
+                    print(f"Move completed: {result}")
+    except (KeyboardInterrupt, EOFError, asyncio.CancelledError):
+        # While awaiting input, Ctrl+C makes asyncio.run cancel this task instead of raising
         print("\nSession ended by user.")
     finally:
         # Clean up MQTT connection